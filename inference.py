@@ -16,7 +16,8 @@ DTYPE = torch.float32
 @torch.no_grad()
 def main(args):
     """Main function for StreamVC model inference."""
-    model = StreamVC().to(device=DEVICE, dtype=DTYPE).eval()
+    model = StreamVC(depthwise_separable=args.depthwise_separable).to(
+        device=DEVICE, dtype=DTYPE).eval()
 
     encoder_state_dict = st.torch.load_file(args.checkpoint, device=DEVICE)
 
@@ -54,5 +55,7 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--output-path", type=str,
                         default="./out.wav",
                         help="Output file path.")
+    parser.add_argument("--depthwise-separable", action="store_true",
+                        help="Load a model trained with depthwise-separable residual units.")
 
     main(parser.parse_args())
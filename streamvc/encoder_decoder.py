@@ -1,25 +1,31 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.utils.checkpoint import checkpoint
 from einops.layers.torch import Rearrange
 from streamvc.modules import CausalConv1d, CausalConvTranspose1d, FiLM
 
 
 class Encoder(nn.Module):
-    def __init__(self, scale: int, embedding_dim: int, gradient_checkpointing: bool = False):
+    def __init__(self, scale: int, embedding_dim: int, gradient_checkpointing: bool = False,
+                 depthwise_separable: bool = False):
         super().__init__()
         self.encoder = nn.Sequential(
             Rearrange('... samples -> ... 1 samples'),
             CausalConv1d(in_channels=1, out_channels=scale, kernel_size=7),
             nn.ELU(),
             EncoderBlock(scale, 2*scale, stride=2,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             EncoderBlock(2*scale, 4*scale, stride=4,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             EncoderBlock(4*scale, 8*scale, stride=5,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             EncoderBlock(8*scale, 16*scale, stride=8,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             CausalConv1d(16*scale, embedding_dim, kernel_size=3),
             nn.ELU(),
             Rearrange('... embedding frames -> ... frames embedding')
@@ -30,23 +36,28 @@ class Encoder(nn.Module):
 
 
 class Decoder(nn.Module):
-    def __init__(self, scale: int, embedding_dim: int, conditioning_dim: int, gradient_checkpointing: bool = False):
+    def __init__(self, scale: int, embedding_dim: int, conditioning_dim: int, gradient_checkpointing: bool = False,
+                 depthwise_separable: bool = False):
         super().__init__()
         self.decoder = SequentialWithFiLM(
             Rearrange('... frames embedding -> ... embedding frames'),
             CausalConv1d(embedding_dim, 16*scale, kernel_size=7),
             nn.ELU(),
             DecoderBlock(16*scale, 8*scale, stride=8,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             FiLM(8*scale, conditioning_dim),
             DecoderBlock(8*scale, 4*scale, stride=5,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             FiLM(4*scale, conditioning_dim),
             DecoderBlock(4*scale, 2*scale, stride=4,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             FiLM(2*scale, conditioning_dim),
             DecoderBlock(2*scale, scale, stride=2,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             FiLM(scale, conditioning_dim),
             CausalConv1d(scale, 1, kernel_size=7),
             Rearrange('... 1 samples -> ... samples')
@@ -68,15 +79,18 @@ class SequentialWithFiLM(nn.Sequential):
 
 class EncoderBlock(nn.Module):
     def __init__(self, in_channels: int, out_channels: int, stride: int,
-                 gradient_checkpointing: bool = False):
+                 gradient_checkpointing: bool = False, depthwise_separable: bool = False):
         super().__init__()
         self.block = nn.Sequential(
             ResidualUnit(in_channels, dilation=1,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             ResidualUnit(in_channels, dilation=3,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             ResidualUnit(in_channels, dilation=9,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             CausalConv1d(in_channels, out_channels,
                          kernel_size=2*stride, stride=stride),
             nn.ELU()
@@ -97,17 +111,20 @@ class EncoderBlock(nn.Module):
 
 class DecoderBlock(nn.Sequential):
     def __init__(self, in_channels: int, out_channels: int, stride: int,
-                 gradient_checkpointing: bool = False):
+                 gradient_checkpointing: bool = False, depthwise_separable: bool = False):
         super().__init__()
         self.block = nn.Sequential(
             CausalConvTranspose1d(in_channels, out_channels,
                                   kernel_size=2*stride, stride=stride),
             ResidualUnit(out_channels, dilation=1,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             ResidualUnit(out_channels, dilation=3,
-                         gradient_checkpointing=gradient_checkpointing),
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable),
             ResidualUnit(out_channels, dilation=9,
-                         gradient_checkpointing=gradient_checkpointing)
+                         gradient_checkpointing=gradient_checkpointing,
+                         depthwise_separable=depthwise_separable)
         )
         self.gradient_checkpointing = gradient_checkpointing
 
@@ -124,24 +141,38 @@ class DecoderBlock(nn.Sequential):
 
 
 class ResidualUnit(nn.Module):
-    def __init__(self, channels: int, dilation: int, kernel_size: int = 7, gradient_checkpointing=False, **kwargs):
+    def __init__(self, channels: int, dilation: int, kernel_size: int = 7, gradient_checkpointing=False,
+                 depthwise_separable: bool = False, **kwargs):
         super().__init__()
+        # With the pointwise convolution below, a depthwise dilated convolution
+        # forms a depthwise-separable convolution. Narrow layers are kept dense
+        # since grouped convolutions are not faster for few channels.
+        groups = channels if depthwise_separable and channels >= 64 else 1
         self.unit = nn.Sequential(
             CausalConv1d(channels, channels, kernel_size,
-                         dilation=dilation, **kwargs),
+                         dilation=dilation, groups=groups, **kwargs),
             nn.ELU(),
             CausalConv1d(channels, channels, kernel_size=1, **kwargs),
             nn.ELU()
         )
         self.gradient_checkpointing = gradient_checkpointing
 
+    def _unit_forward(self, x: torch.Tensor):
+        dilated_conv, dilated_activation, pointwise_conv, pointwise_activation = self.unit
+        out = dilated_activation(dilated_conv(x))
+        # The pointwise convolution has no causal padding and no streaming state,
+        # so we skip the CausalConv1d dispatch and run the convolution directly.
+        out = F.conv1d(out, pointwise_conv.weight, pointwise_conv.bias,
+                       groups=pointwise_conv.groups)
+        return pointwise_activation(out) + x
+
     def _run_function(self):
         def custom_forward(*inputs):
-            return self.unit(inputs[0]) + inputs[0]
+            return self._unit_forward(inputs[0])
         return custom_forward
 
     def forward(self, x: torch.Tensor):
         if self.gradient_checkpointing:
             return checkpoint(self._run_function(), x, use_reentrant=False)
         else:
-            return self.unit(x) + x
+            return self._unit_forward(x)
@@ -9,15 +9,19 @@ from streamvc._utils import auto_batching
 
 
 class StreamVC(nn.Module):
-    def __init__(self, sample_rate: int = 16_000, gradient_checkpointing: bool = False):
+    def __init__(self, sample_rate: int = 16_000, gradient_checkpointing: bool = False,
+                 depthwise_separable: bool = False):
         super().__init__()
         self.content_encoder = Encoder(scale=64, embedding_dim=64,
-                                       gradient_checkpointing=gradient_checkpointing)
+                                       gradient_checkpointing=gradient_checkpointing,
+                                       depthwise_separable=depthwise_separable)
         self.speech_encoder = Encoder(scale=32, embedding_dim=64,
-                                      gradient_checkpointing=gradient_checkpointing)
+                                      gradient_checkpointing=gradient_checkpointing,
+                                      depthwise_separable=depthwise_separable)
         self.speech_pooling = LearnablePooling(embedding_dim=64)
         self.decoder = Decoder(scale=40, embedding_dim=74, conditioning_dim=64,
-                               gradient_checkpointing=gradient_checkpointing)
+                               gradient_checkpointing=gradient_checkpointing,
+                               depthwise_separable=depthwise_separable)
         self.f0_estimator = F0Estimator(sample_rate=sample_rate, frame_length_ms=20,
                                         yin_thresholds=(0.05, 0.1, 1.5), whitening=True)
         self.energy_estimator = EnergyEstimator(
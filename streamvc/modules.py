@@ -2,22 +2,31 @@ from functools import partial
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from einops.layers.torch import EinMix
 from streamvc._utils import auto_batching
 
 
 class LearnablePooling(nn.Module):
     def __init__(self, embedding_dim: int):
         super().__init__()
-        self.to_weights = nn.Sequential(
-            EinMix('b f e -> b f', weight_shape='e', e=embedding_dim),
-            nn.Softmax(dim=-1)
-        )
+        bound = embedding_dim ** -0.5
+        self.query = nn.Parameter(
+            torch.empty(embedding_dim).uniform_(-bound, bound))
 
     @auto_batching(('* f e',), '* e')
     def forward(self, x: torch.Tensor):
-        weights = self.to_weights(x)
-        return torch.einsum('b f e, b f -> b e', x, weights)
+        # Unscaled single query attention where the frames are both the keys and the values.
+        # The fused attention kernels require a (batch, heads, length, embedding) layout,
+        # so we add a single head dimension.
+        query = self.query.expand(x.shape[0], 1, 1, -1)
+        x = x.unsqueeze(dim=1)
+        return F.scaled_dot_product_attention(query, x, x, scale=1.0).squeeze(dim=(1, 2))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Support checkpoints where the query was an EinMix layer.
+        legacy_key = f'{prefix}to_weights.0.weight'
+        if legacy_key in state_dict:
+            state_dict[f'{prefix}query'] = state_dict.pop(legacy_key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 class CausalConv1d(nn.Conv1d):
@@ -27,12 +36,20 @@ class CausalConv1d(nn.Conv1d):
 
         assert 'padding' not in kwargs
 
+        causal_padding = max(0, dilation * (kernel_size - 1) - (stride - 1))
+
+        # For undilated zero padded convolutions we let the convolution kernel
+        # pad both sides and trim the right side of the output, this avoids
+        # materializing a padded copy of the input on every forward. Dilated
+        # convolutions would compute too many discarded outputs on the right.
+        fused_padding = padding_mode == 'zeros' and dilation == 1
+
         super().__init__(
             in_channels=in_channels,
             out_channels=out_channels,
             kernel_size=kernel_size,
             stride=stride,
-            padding=0,
+            padding=causal_padding if fused_padding else 0,
             dilation=dilation,
             **kwargs
         )
@@ -41,8 +58,8 @@ class CausalConv1d(nn.Conv1d):
         self.stride = stride
         self.dilation = dilation
 
-        self.causal_padding = max(
-            0, dilation * (kernel_size - 1) - (stride - 1))
+        self.causal_padding = causal_padding
+        self.fused_padding = fused_padding
         self.padding_mode = padding_mode
 
         self.register_buffer('streaming_buffer',
@@ -56,10 +73,18 @@ class CausalConv1d(nn.Conv1d):
         return F.pad(x, pad=(self.causal_padding, 0),
                      mode=self.padding_mode)
 
+    def _causal_output_length(self, num_samples: int) -> int:
+        kernel_reception_field = self.dilation * (self.kernel_size - 1) + 1
+        return (num_samples + self.causal_padding - kernel_reception_field) // self.stride + 1
+
     def forward(self, x):
         if self.streaming_mode:
             return self.streaming_forward(x)
 
+        if self.fused_padding:
+            out = super().forward(x)
+            return out[..., :self._causal_output_length(x.shape[-1])]
+
         return super().forward(self._pad(x))
 
     def init_streaming_buffer(self):
@@ -84,7 +109,9 @@ class CausalConv1d(nn.Conv1d):
         ready_input = full_input[..., :num_elements_for_forward]
         new_buffer_size = num_samples - num_strides * self.stride
         self.streaming_buffer = full_input[..., -new_buffer_size:]
-        return super().forward(ready_input)
+        # The streaming buffer replaces the causal padding.
+        return F.conv1d(ready_input, self.weight, self.bias, self.stride,
+                        0, self.dilation, self.groups)
 
 
 class CausalConvTranspose1d(nn.ConvTranspose1d):
@@ -105,18 +132,18 @@ class CausalConvTranspose1d(nn.ConvTranspose1d):
             **kwargs
         )
 
-        causal_trim = max(0, dilation * (kernel_size - 1) - (stride - 1))
-
-        # we trim the output on the right side
-        # see https://github.com/lucidrains/audiolm-pytorch/issues/8
-        if causal_trim > 0:
-            self.trim = lambda x: x[..., :-causal_trim]
-        else:
-            self.trim = lambda x: x
+        self.causal_trim = max(
+            0, dilation * (kernel_size - 1) - (stride - 1))
 
     def forward(self, x: torch.Tensor):
         out = super().forward(x)
-        return self.trim(out)
+        if self.causal_trim == 0:
+            return out
+        # we trim the output on the right side
+        # see https://github.com/lucidrains/audiolm-pytorch/issues/8
+        # The following convolution needs a contiguous input, so we copy the
+        # trimmed view once here instead of leaving it to every consumer.
+        return out[..., :-self.causal_trim].contiguous()
 
 
 class FiLM(nn.Module):
@@ -126,10 +153,19 @@ class FiLM(nn.Module):
 
     def __init__(self, dim: int, conditioning_dim: int):
         super().__init__()
-        self.to_gamma = nn.Linear(conditioning_dim, dim)
-        self.to_beta = nn.Linear(conditioning_dim, dim)
+        self.to_gamma_beta = nn.Linear(conditioning_dim, 2 * dim)
 
     def forward(self, x: torch.Tensor, condition: torch.Tensor):
-        gamma = self.to_gamma(condition).unsqueeze(dim=-1)
-        beta = self.to_beta(condition).unsqueeze(dim=-1)
-        return x * gamma + beta
+        gamma, beta = self.to_gamma_beta(
+            condition).unsqueeze(dim=-1).chunk(2, dim=-2)
+        return torch.addcmul(beta, x, gamma)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Support checkpoints with separate gamma and beta projections.
+        for name in ('weight', 'bias'):
+            gamma_key = f'{prefix}to_gamma.{name}'
+            beta_key = f'{prefix}to_beta.{name}'
+            if gamma_key in state_dict and beta_key in state_dict:
+                state_dict[f'{prefix}to_gamma_beta.{name}'] = torch.cat(
+                    [state_dict.pop(gamma_key), state_dict.pop(beta_key)], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
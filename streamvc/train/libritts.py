@@ -1,42 +1,106 @@
+import os
+import warnings
+from functools import partial
 from math import ceil
 from datasets import load_dataset
 from torch.utils.data import DataLoader
+import numpy as np
 import torch
 import torch.nn as nn
 from datasets import Audio
 
 DATASET_PATH = "blabble-io/libritts"
 SAMPLE_RATE = 16000
+SAMPLES_PER_FRAME = 320
 
 
-def get_libritts_dataloader(split,  batch_size, num_workers=0, limit_samples=None, streaming=True) -> DataLoader:
+def get_libritts_dataloader(split,  batch_size, num_workers=None, limit_samples=None, streaming=True,
+                            labels_dir=None, return_ids=False, pin_memory=True, persistent_workers=True,
+                            prefetch_factor=4) -> DataLoader:
     """
     Get a dataloader for the LibriTTS dataset.
     :param split: The split of the dataset to load.
     :param batch_size: The batch size.
-    :param num_workers: The number of workers to use for data loading.
+    :param num_workers: The number of workers to use for data loading,
+        defaults to the number of CPUs up to 8. A streamed dataset is split
+        across the workers by whole shards, so the number of workers is capped
+        at the number of shards. Each worker ends the split with its own
+        partial batch, limit the number of batches (e.g. with islice) rather
+        than the number of rows to get full batches.
     :param limit_samples: The number of samples in a batch (length of audio)
         with padding.
     :param streaming: Whether to stream the dataset.
-    :param select: A function to select the rows to load.
+    :param labels_dir: A directory with precomputed per-utterance frame labels
+        (see `save_labels`). If given, the padded labels are added to each batch,
+        utterances without saved labels get ignored (-1) labels.
+    :param return_ids: Whether to add the utterance ids to each batch.
+    :param pin_memory: Whether to load the batches into pinned memory.
+    :param persistent_workers: Whether to keep the workers alive between iterations
+        over the dataloader. Ignored when `num_workers` is 0.
+    :param prefetch_factor: The number of batches loaded in advance by each worker.
+        Ignored when `num_workers` is 0.
     :return: A pytorch dataloader for the LibriTTS dataset.
     """
     dataset = load_dataset(DATASET_PATH, "all",
                            split=split, streaming=streaming)
-    dataset = dataset.select_columns('audio')
+    dataset = dataset.select_columns(['audio', 'id'])
     dataset = dataset.cast_column('audio', Audio(sampling_rate=SAMPLE_RATE))
     dataset = dataset.with_format('torch')
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    if streaming:
+        # Workers without a shard of the streamed dataset would stay idle.
+        num_workers = min(num_workers, dataset.n_shards)
     dataloader = DataLoader(
         dataset,
         batch_size=batch_size,
         num_workers=num_workers,
-        collate_fn=lambda samples: concat_and_pad_tensors([
-            cap(sample['audio']['array'], limit_samples)
-            for sample in samples])
+        pin_memory=pin_memory,
+        persistent_workers=persistent_workers and num_workers > 0,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        collate_fn=partial(collate_samples, limit_samples=limit_samples,
+                           labels_dir=labels_dir, return_ids=return_ids)
     )
     return dataloader
 
 
+def collate_samples(samples, limit_samples=None, labels_dir=None, return_ids=False):
+    batch, mask = concat_and_pad_tensors([
+        cap(sample['audio']['array'], limit_samples)
+        for sample in samples])
+    outputs = [batch, mask]
+    if labels_dir is not None:
+        num_frames = batch.shape[-1] // SAMPLES_PER_FRAME
+        outputs.append(torch.stack([
+            pad_labels(load_labels(labels_dir, sample['id']), num_frames)
+            for sample in samples]))
+    if return_ids:
+        outputs.append([sample['id'] for sample in samples])
+    return tuple(outputs)
+
+
+def save_labels(labels_dir: str, utterance_id: str, labels: torch.Tensor) -> None:
+    np.save(os.path.join(labels_dir, f"{utterance_id}.npy"),
+            labels.cpu().numpy().astype(np.int16))
+
+
+def load_labels(labels_dir: str, utterance_id: str) -> torch.Tensor:
+    labels_path = os.path.join(labels_dir, f"{utterance_id}.npy")
+    if not os.path.exists(labels_path):
+        warnings.warn(f"No cached labels for utterance {utterance_id} in {labels_dir}, "
+                      "its frames are ignored.")
+        return torch.empty(0, dtype=torch.long)
+    return torch.from_numpy(np.load(labels_path)).long()
+
+
+def pad_labels(labels: torch.Tensor, num_frames: int) -> torch.Tensor:
+    """
+    Trim or pad the labels of a single utterance with -1 (ignored label) to match the number of frames in the batch.
+    """
+    labels = labels[:num_frames]
+    return nn.functional.pad(labels, (0, num_frames - labels.shape[0]), mode='constant', value=-1)
+
+
 def cap(x: torch.Tensor, max_len: int) -> torch.Tensor:
     if (max_len is None) or (x.shape[0] <= max_len):
         return x
@@ -69,25 +69,30 @@ class ReconstructionLoss(nn.Module):
         self.gradient_checkpointing = gradient_checkpointing
         self.epsilon = 1e-6
 
-    def _calculate_for_scale(self):
-        def custom_run(*inputs):
-            original, generated, s_exp, mask_ratio = inputs[0], inputs[1], inputs[2], inputs[3]
-            s = 2 ** s_exp
-            # Should satisfy n_fft >= win_length && ((n_fft // 2) + 1) >= n_mels.
-            n_fft = 2 ** 11
-            window_size = s
-            hop_length = int(s / 4)
-            mel_spectrogram = MelSpectrogram(
+        # Should satisfy n_fft >= win_length && ((n_fft // 2) + 1) >= n_mels.
+        n_fft = 2 ** 11
+        self.scales = [2 ** s_exp for s_exp in range(6, 12)]
+        # The mel filterbanks and windows are created once for all the scales.
+        self.mel_spectrograms = nn.ModuleList([
+            MelSpectrogram(
                 sample_rate=self.sample_rate,
-                win_length=window_size,
+                win_length=s,
                 n_fft=n_fft,
-                hop_length=hop_length,
+                hop_length=int(s / 4),
                 n_mels=self.mel_bins
-            ).to(original.device)
+            )
+            for s in self.scales
+        ])
+
+    def _calculate_for_scale(self):
+        def custom_run(*inputs):
+            original, generated, scale_index, mask_ratio = inputs[0], inputs[1], inputs[2], inputs[3]
+            s = self.scales[scale_index]
+            mel_spectrogram = self.mel_spectrograms[scale_index]
             orig_audio_spec = mel_spectrogram(original)
             generated_audio_spec = mel_spectrogram(generated)
 
-            alpha_s = torch.sqrt(torch.tensor(s) / 2).to(original.device)
+            alpha_s = (s / 2) ** 0.5
             l1_loss = torch.abs(orig_audio_spec - generated_audio_spec)
             l1_loss = masked_mean_from_ratios(l1_loss, mask_ratio)
             l2_log_loss = torch.pow(
@@ -102,12 +107,12 @@ class ReconstructionLoss(nn.Module):
     def forward(self, original: torch.Tensor, generated: torch.Tensor, mask_ratio: torch.Tensor):
         assert original.shape == generated.shape
         loss = torch.tensor(0., device=original.device, dtype=original.dtype)
-        for s_exp in range(6, 12):
+        for scale_index in range(len(self.scales)):
             if self.gradient_checkpointing:
                 loss += checkpoint(
                     self._calculate_for_scale(),
-                    original, generated, s_exp, mask_ratio,
+                    original, generated, scale_index, mask_ratio,
                     use_reentrant=False)
             else:
-                loss += self._calculate_for_scale()(original, generated, s_exp, mask_ratio)
+                loss += self._calculate_for_scale()(original, generated, scale_index, mask_ratio)
         return loss
@@ -1,20 +1,23 @@
 import argparse
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
+from typing import Optional
 
 import einops
 import safetensors as st
 import safetensors.torch
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from accelerate import Accelerator, DataLoaderConfiguration
 from accelerate.utils import ProjectConfiguration
 
 from streamvc.model import StreamVC
 from streamvc.train.discriminator import Discriminator
 from streamvc.train.encoder_classifier import EncoderClassifier
-from streamvc.train.libritts import get_libritts_dataloader
+from streamvc.train.libritts import get_libritts_dataloader, save_labels
 from streamvc.train.loss import GeneratorLoss, DiscriminatorLoss, FeatureLoss, ReconstructionLoss
 
 accelerator = Accelerator(log_with="tensorboard",
@@ -30,10 +33,16 @@ torch.backends.cudnn.benchmark = True
 NUM_CLASSES = 100
 EMBEDDING_DIMS = 64
 SAMPLES_PER_FRAME = 320
+HUBERT_WINDOW_SIZE = 400
+HUBERT_LAYER = 7
 TRAIN_SPLIT = "train.clean.100"
 DEV_SPLIT = "dev.clean"
 TEST_SPLIT = "test.clean"
+ACCURACY_NUM_BATCHES = 10
 DEVICE = accelerator.device
+# Histograms are computed and written in the background to not block training.
+histogram_executor = ThreadPoolExecutor(max_workers=1)
+histogram_futures = []
 
 
 def print_time(s):
@@ -71,43 +80,175 @@ def print_cuda_memory(s):
 
 
 @torch.no_grad()
-def get_batch_labels(hubert_model: nn.Module, batch: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+def get_batch_labels(hubert_model: nn.Module, cluster_centers: torch.Tensor, batch: torch.Tensor,
+                     mask: torch.Tensor) -> torch.Tensor:
     """
     Get hubert output labels for a given audio samples batch.
 
     :param hubert_model: Hubert model with discrete output labels.
+    :param cluster_centers: The hubert k-means centroids on the device (see `get_cluster_centers`).
     :param batch: A batch of audio samples.
     :return: The output predictions generated by the Hubert model for the input batch.
     """
-    labels = []
-    frame_mask = mask.unfold(
-        dimension=-1, size=SAMPLES_PER_FRAME, step=SAMPLES_PER_FRAME).all(dim=-1)
-    for sample in batch:
-        single_sample_batch = einops.rearrange(sample, 's -> 1 1 s')
-        labels.append(hubert_model.units(single_sample_batch))
-    labels = torch.stack(labels, dim=0)
+    num_frames = mask.shape[-1] // SAMPLES_PER_FRAME
+    frame_mask = mask[..., :num_frames * SAMPLES_PER_FRAME].reshape(
+        mask.shape[0], num_frames, SAMPLES_PER_FRAME).all(dim=-1)
+    # `hubert_model.units` only supports a single utterance (it squeezes the batch
+    # dimension before the k-means lookup on the CPU), so we reproduce it for the
+    # whole batch: a single encoder forward followed by a nearest centroid search.
+    hubert_padding = (HUBERT_WINDOW_SIZE - SAMPLES_PER_FRAME) // 2
+    batch_in = F.pad(einops.rearrange(batch, 'b s -> b 1 s'),
+                     (hubert_padding, hubert_padding))
+    # The labels are cluster assignments, so running the encoder in bfloat16 is
+    # safe. The distances to the centroids are still computed in float32.
+    with torch.autocast(device_type=batch.device.type, dtype=torch.bfloat16):
+        features, _ = hubert_model.encode(batch_in, layer=HUBERT_LAYER)
+    labels = torch.cdist(features.float(), cluster_centers).argmin(dim=-1)
     assert labels.shape == frame_mask.shape
     labels[~frame_mask] = -1
     return labels
 
 
+def to_device(*tensors: torch.Tensor) -> list[torch.Tensor]:
+    # The dataloaders use pinned memory, so the copies overlap with the computation.
+    return [tensor.to(accelerator.device, non_blocking=True) for tensor in tensors]
+
+
+def get_cluster_centers(hubert_model: nn.Module) -> torch.Tensor:
+    """
+    Copy the hubert k-means centroids to the device once, for reuse by `get_batch_labels`.
+    """
+    return torch.from_numpy(hubert_model.kmeans.cluster_centers_).to(
+        device=accelerator.device, dtype=torch.float32)
+
+
+def load_hubert_model() -> nn.Module:
+    # The main process downloads the model to the hub cache before the others load it.
+    with accelerator.main_process_first():
+        hubert_model = torch.hub.load("bshall/hubert:main", "hubert_discrete",
+                                      trust_repo=True)
+    return hubert_model.eval().to(accelerator.device)
+
+
+def cache_hubert_labels(splits: dict[str, Optional[int]], args: argparse.Namespace) -> list[str]:
+    """
+    Compute the hubert labels of the utterances in the dataset splits once and save them to disk.
+    Every process iterates the same batches as the training, and labels every `num_processes`-th batch.
+
+    :param splits: The splits of the dataset to label, mapped to the number of batches to label
+        from the start of the split (None for the whole split).
+    :param args: Hyperparameters for training.
+    :return: The directories with the saved labels of each split.
+    """
+    labels_dirs = []
+    missing = []
+    for split, num_batches in splits.items():
+        labels_dir = os.path.join(
+            args.labels_cache_path, f"{split}_{args.limit_batch_samples}")
+        labels_dirs.append(labels_dir)
+        done_marker = os.path.join(
+            labels_dir, f".done_{num_batches or 'all'}x{args.batch_size}")
+        if not os.path.exists(done_marker):
+            missing.append((split, num_batches, labels_dir, done_marker))
+
+    if not missing:
+        return labels_dirs
+
+    hubert_model = load_hubert_model()
+    cluster_centers = get_cluster_centers(hubert_model)
+    for split, num_batches, labels_dir, done_marker in missing:
+        print_time(f"caching hubert labels for {split} in {labels_dir}")
+        os.makedirs(labels_dir, exist_ok=True)
+        dataloader = get_libritts_dataloader(
+            split,
+            args.batch_size,
+            limit_samples=args.limit_batch_samples,
+            streaming=args.dataset_streaming,
+            return_ids=True
+        )
+        for batch_index, (batch, mask, ids) in enumerate(islice(dataloader, num_batches)):
+            if batch_index % accelerator.num_processes != accelerator.process_index:
+                continue
+            batch, mask = to_device(batch, mask)
+            labels = get_batch_labels(
+                hubert_model, cluster_centers, batch, mask)
+            num_frames = mask.sum(dim=-1) // SAMPLES_PER_FRAME
+            for utterance_id, utterance_labels, utterance_frames in zip(ids, labels, num_frames):
+                save_labels(labels_dir, utterance_id,
+                            utterance_labels[:utterance_frames])
+        accelerator.wait_for_everyone()
+        if accelerator.is_main_process:
+            open(done_marker, "w").close()
+    del hubert_model
+    accelerator.wait_for_everyone()
+    return labels_dirs
+
+
+def with_hubert_labels(dataloader, hubert_model: Optional[nn.Module]):
+    """
+    Yield the batches of a dataloader on the device with their hubert labels. If no hubert
+    model is given the dataloader is expected to already yield the cached labels.
+    """
+    if hubert_model is None:
+        for batch, mask, labels in dataloader:
+            yield to_device(batch, mask, labels)
+        return
+    cluster_centers = get_cluster_centers(hubert_model)
+    for batch, mask in dataloader:
+        batch, mask = to_device(batch, mask)
+        yield batch, mask, get_batch_labels(hubert_model, cluster_centers, batch, mask)
+
+
+def add_histograms(histograms: dict[str, torch.Tensor], step: int):
+    summary_writer = accelerator.get_tracker("tensorboard").tracker
+    for tag, values in histograms.items():
+        summary_writer.add_histogram(tag, values, global_step=step)
+
+
+def wait_for_histograms():
+    # Re-raises any error of the histograms written in the background.
+    while histogram_futures:
+        histogram_futures.pop(0).result()
+
+
+def submit_histograms(histograms: dict[str, torch.Tensor], step: int):
+    wait_for_histograms()
+    histogram_futures.append(
+        histogram_executor.submit(add_histograms, histograms, step))
+
+
 @accelerator.on_main_process
 def log_gradients(model, step):
-    summary_writer = accelerator.get_tracker("tensorboard").tracker
-    for name, param in model.named_parameters():
-        if param.grad is not None:
-            summary_writer.add_histogram(
-                f"gradients/{name}", param.grad, global_step=step)
+    histograms = {
+        f"gradients/{name}": param.grad.detach().cpu()
+        for name, param in model.named_parameters()
+        if param.grad is not None
+    }
+    submit_histograms(histograms, step)
 
 
 @accelerator.on_main_process
-def log_labels(outputs_flat, labels_flat, step):
-    _, predicted = torch.max(outputs_flat.data, 1)
-    summary_writer = accelerator.get_tracker("tensorboard").tracker
-    summary_writer.add_histogram(
-        "labels/content_encoder", predicted, global_step=step)
-    summary_writer.add_histogram(
-        "labels/hubert", labels_flat, global_step=step)
+def log_labels(outputs, labels, step):
+    predicted = outputs.detach().argmax(dim=-1)
+    histograms = {
+        "labels/content_encoder": predicted.flatten().cpu(),
+        "labels/hubert": labels.flatten().cpu()
+    }
+    submit_histograms(histograms, step)
+
+
+def get_optimizer(params, lr, args):
+    # The fused implementation updates all the parameters in a single kernel,
+    # it requires the parameters to already be on the GPU.
+    fused = accelerator.device.type == "cuda"
+    return torch.optim.AdamW(
+        params=params,
+        lr=lr,
+        betas=args.betas,
+        weight_decay=args.weight_decay,
+        fused=fused,
+        foreach=not fused
+    )
 
 
 def get_lr_Scheduler(optimizer, args, discriminator=False):
@@ -153,97 +294,110 @@ def get_lr_Scheduler(optimizer, args, discriminator=False):
         raise ValueError(f"Unknown scheduler: {args.scheduler}")
 
 
-def train_content_encoder(content_encoder: nn.Module, hubert_model: nn.Module, args: argparse.Namespace) -> nn.Module:
+def train_content_encoder(content_encoder: nn.Module, train_labels_dir: Optional[str], dev_labels_dir: Optional[str],
+                          hubert_model: Optional[nn.Module], args: argparse.Namespace) -> nn.Module:
     """
     Train a content encoder as a classifier to predict the same labels as a discrete hubert model.
 
     :param content_encoder: A content encoder wrapped with a linear layer to
-    :param hubert_model: Hubert model with discrete output labels.
+    :param train_labels_dir: Directory with the cached hubert labels of the train split,
+        None when the labels are computed on the fly.
+    :param dev_labels_dir: Directory with the cached hubert labels of the dev split,
+        None when the labels are computed on the fly.
+    :param hubert_model: Hubert model with discrete output labels to compute the labels on the fly,
+        None when the labels are cached.
     :param lr: Learning rate.
     :param num_epochs: Number of epochs.
     :return: The trained content encoder wrapped with a linear layer for classification.
     """
     # TODO: add epochs or number of steps when we know how much time it takes to train the model.
     wrapped_content_encoder = EncoderClassifier(
-        content_encoder, EMBEDDING_DIMS, NUM_CLASSES, dropout=args.encoder_dropout).train()
+        content_encoder, EMBEDDING_DIMS, NUM_CLASSES, dropout=args.encoder_dropout).to(accelerator.device).train()
     criterion = nn.CrossEntropyLoss(ignore_index=-1)
-    optimizer = torch.optim.AdamW(
-        params=wrapped_content_encoder.parameters(),
-        lr=args.lr,
-        betas=args.betas,
-        weight_decay=args.weight_decay
-    )
+    optimizer = get_optimizer(
+        wrapped_content_encoder.parameters(), args.lr, args)
     scheduler = get_lr_Scheduler(optimizer, args)
 
+    if args.compile:
+        # Compiling in place keeps the state dict keys of the saved checkpoints.
+        wrapped_content_encoder.compile()
+
     dataloader = get_libritts_dataloader(
         TRAIN_SPLIT,
         args.batch_size,
         limit_samples=args.limit_batch_samples,
-        streaming=args.dataset_streaming
+        streaming=args.dataset_streaming,
+        labels_dir=train_labels_dir
     )
     dev_dataloader = get_libritts_dataloader(
         DEV_SPLIT,
         args.batch_size,
         limit_samples=args.limit_batch_samples,
-        streaming=args.dataset_streaming
+        streaming=args.dataset_streaming,
+        labels_dir=dev_labels_dir
     )
 
     [
         wrapped_content_encoder,
         optimizer,
-        dataloader,
-        dev_dataloader,
         criterion,
         scheduler
     ] = accelerator.prepare(
         wrapped_content_encoder,
         optimizer,
-        dataloader,
-        dev_dataloader,
         criterion,
         scheduler
     )
-
-    # TODO: distributed inference with the hubert model
-    hubert_model.to(accelerator.device)
-    costs = []
+    # The batches are copied to the device by `to_device` without blocking.
+    dataloader = accelerator.prepare_data_loader(
+        dataloader, device_placement=False)
+    dev_dataloader = accelerator.prepare_data_loader(
+        dev_dataloader, device_placement=False)
+
+    # Losses are summed on the device and only fetched when printed
+    # to avoid a device synchronization on every step.
+    costs_sum = torch.zeros((), device=accelerator.device)
+    costs_count = 0
     global_step = 0
     for epoch in range(0, args.num_epochs):
         print_time(f"epoch num: {epoch}")
-        for step, (batch, mask) in enumerate(islice(dataloader, args.limit_num_batches)):
-            labels = get_batch_labels(hubert_model, batch, mask)
+        for step, (batch, mask, labels) in enumerate(islice(with_hubert_labels(dataloader, hubert_model), args.limit_num_batches)):
             with accelerator.accumulate(wrapped_content_encoder):
                 outputs = wrapped_content_encoder(batch)
-                outputs_flat = outputs.view(-1, NUM_CLASSES)
-                labels_flat = labels.view(-1)
-                loss = criterion(outputs_flat, labels_flat)
+                # The classes dimension is expected right after the batch dimension.
+                loss = criterion(outputs.transpose(1, 2), labels)
                 accelerator.backward(loss)
 
                 if args.log_gradient_interval and (global_step + 1) % args.log_gradient_interval == 0:
                     log_gradients(wrapped_content_encoder, global_step)
 
                 optimizer.step()
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
                 scheduler.step(global_step)
+                costs_sum += loss.detach()
+                costs_count += 1
+
+            # print loss
+            if (global_step + 1) % args.log_interval == 0:
+                cost = (costs_sum / costs_count).item()
                 accelerator.log(
                     {
-                        "loss/content_encoder": loss.item(),
+                        "loss/content_encoder": cost,
                         "lr/content_encoder": scheduler.get_last_lr()[0],
                         "allocated_memory": torch.cuda.max_memory_allocated()
                         if accelerator.device.type == "cuda"
                         else 0
                     },
                     step=global_step)
-                costs.append(loss.item())
-
-            # print loss
-            if (global_step + 1) % args.log_interval == 0:
-                print_time(
-                    f'[{epoch}, {step:5}] loss: {torch.tensor(costs).mean().item():.4}')
-                costs = []
+                print_time(f'[{epoch}, {step:5}] loss: {cost:.4}')
+                costs_sum.zero_()
+                costs_count = 0
+                # The reported peak memory covers the whole log interval.
+                if accelerator.device.type == "cuda":
+                    torch.cuda.reset_peak_memory_stats()
 
             if args.log_labels_interval and (global_step + 1) % args.log_labels_interval == 0:
-                log_labels(outputs_flat, labels_flat, global_step)
+                log_labels(outputs, labels, global_step)
 
             # save model checkpoints
             if (global_step + 1) % args.model_checkpoint_interval == 0:
@@ -256,9 +410,9 @@ def train_content_encoder(content_encoder: nn.Module, hubert_model: nn.Module, a
 
             if (global_step + 1) % args.accuracy_interval == 0:
                 accuracy = compute_content_encoder_accuracy(
-                    islice(dev_dataloader, 10),
-                    wrapped_content_encoder,
-                    hubert_model)
+                    islice(with_hubert_labels(
+                        dev_dataloader, hubert_model), ACCURACY_NUM_BATCHES),
+                    wrapped_content_encoder)
                 accuracies = accelerator.gather_for_metrics([accuracy])
                 accuracies = torch.tensor(accuracies)
                 gathered_accuracy = accuracies.mean().item()
@@ -268,29 +422,39 @@ def train_content_encoder(content_encoder: nn.Module, hubert_model: nn.Module, a
                     },
                     step=global_step)
                 print_time(f"accuracy: {accuracy:.2f}%")
-            if accelerator.device.type == "cuda":
-                torch.cuda.reset_peak_memory_stats()
 
             global_step += 1
 
 
-@torch.no_grad()
-def compute_content_encoder_accuracy(dataloader, wrapped_content_encoder: nn.Module, hubert_model: nn.Module):
+@torch.inference_mode()
+def compute_content_encoder_accuracy(dataloader, wrapped_content_encoder: nn.Module):
     correct = 0
     total = 0
-    wrapped_content_encoder.to(accelerator.device).eval()
-    for (batch, mask) in dataloader:
-        batch = batch.to(accelerator.device)
-        labels = get_batch_labels(hubert_model, batch, mask)
+    wrapped_content_encoder.eval()
+    for (batch, mask, labels) in dataloader:
         outputs = wrapped_content_encoder(batch)
-        outputs_flat = outputs.view(-1, NUM_CLASSES)
-        labels_flat = labels.view(-1)
-        _, predicted = torch.max(outputs_flat.data, 1)
-        total += torch.sum(labels_flat != -1).item()
-        correct += (predicted == labels_flat).sum().item()
+        predicted = outputs.argmax(dim=-1)
+        valid_labels = labels != -1
+        total += valid_labels.sum()
+        correct += (predicted == labels).masked_select(valid_labels).sum()
     wrapped_content_encoder.train()
 
-    return 100 * correct / total
+    return 100 * correct.item() / total.item()
+
+
+def split_discriminator_outputs(outputs: list[list[torch.Tensor]], batch_size: int):
+    """
+    Split the discriminator outputs for a concatenation of two batches into the outputs of each batch.
+
+    :param outputs: The discriminator outputs, a list of features per scale.
+    :param batch_size: The size of the first batch.
+    :return: The discriminator outputs for the first batch and the second batch.
+    """
+    first = [[features[:batch_size] for features in scale]
+             for scale in outputs]
+    second = [[features[batch_size:] for features in scale]
+              for scale in outputs]
+    return first, second
 
 
 def train_streamvc(streamvc_model: StreamVC, args: argparse.Namespace) -> None:
@@ -304,8 +468,9 @@ def train_streamvc(streamvc_model: StreamVC, args: argparse.Namespace) -> None:
     # Load PyTorch Models #
     #######################
     generator = streamvc_model
+    generator.to(accelerator.device)
     discriminator = Discriminator(
-        gradient_checkpointing=args.gradient_checkpointing)
+        gradient_checkpointing=args.gradient_checkpointing).to(accelerator.device)
 
     for param in generator.content_encoder.parameters():
         param.requires_grad = False
@@ -313,26 +478,25 @@ def train_streamvc(streamvc_model: StreamVC, args: argparse.Namespace) -> None:
     #####################
     # Create optimizers #
     #####################
-    optimizer_generator = torch.optim.AdamW(
-        params=[param for param in generator.parameters()
-                if param.requires_grad],
-        lr=args.lr,
-        betas=args.betas,
-        weight_decay=args.weight_decay)
+    optimizer_generator = get_optimizer(
+        [param for param in generator.parameters() if param.requires_grad],
+        args.lr, args)
 
     lr_discriminator = args.lr
     if args.lr_discriminator_multiplier is not None:
         lr_discriminator = args.lr_discriminator_multiplier * lr_discriminator
-    optimizer_discriminator = torch.optim.AdamW(
-        params=discriminator.parameters(),
-        lr=lr_discriminator,
-        betas=args.betas,
-        weight_decay=args.weight_decay)
+    optimizer_discriminator = get_optimizer(
+        discriminator.parameters(), lr_discriminator, args)
 
     scheduler_generator = get_lr_Scheduler(optimizer_generator, args)
     scheduler_discriminator = get_lr_Scheduler(
         optimizer_discriminator, args, discriminator=True)
 
+    if args.compile:
+        # Compiling in place keeps the state dict keys of the saved checkpoints.
+        generator.compile()
+        discriminator.compile()
+
     dataloader = get_libritts_dataloader(
         TRAIN_SPLIT,
         args.batch_size,
@@ -346,6 +510,12 @@ def train_streamvc(streamvc_model: StreamVC, args: argparse.Namespace) -> None:
     reconstruction_loss_fn = ReconstructionLoss(
         gradient_checkpointing=args.gradient_checkpointing)
 
+    if args.compile:
+        generator_loss_fn.compile()
+        discriminator_loss_fn.compile()
+        feature_loss_fn.compile()
+        reconstruction_loss_fn.compile()
+
     [
         generator,
         discriminator,
@@ -353,7 +523,6 @@ def train_streamvc(streamvc_model: StreamVC, args: argparse.Namespace) -> None:
         optimizer_discriminator,
         scheduler_generator,
         scheduler_discriminator,
-        dataloader,
         generator_loss_fn,
         discriminator_loss_fn,
         feature_loss_fn,
@@ -365,18 +534,27 @@ def train_streamvc(streamvc_model: StreamVC, args: argparse.Namespace) -> None:
         optimizer_discriminator,
         scheduler_generator,
         scheduler_discriminator,
-        dataloader,
         generator_loss_fn,
         discriminator_loss_fn,
         feature_loss_fn,
         reconstruction_loss_fn
     )
-
-    costs = []
+    # The batches are copied to the device by `to_device` without blocking.
+    dataloader = accelerator.prepare_data_loader(
+        dataloader, device_placement=False)
+
+    # Losses are summed on the device and only fetched when printed
+    # to avoid a device synchronization on every step.
+    costs_sum = torch.zeros(4, device=accelerator.device)
+    costs_count = 0
     global_step = 0
     for epoch in range(0, args.num_epochs):
         print_time(f"epoch num: {epoch}")
         for step, (batch, mask) in enumerate(islice(dataloader, args.limit_num_batches)):
+            batch, mask = to_device(batch, mask)
+            optimizer_generator.zero_grad(set_to_none=True)
+            optimizer_discriminator.zero_grad(set_to_none=True)
+
             x_pred_t = generator(batch, batch)
             # Remove the first 2 frames from the generated audio
             # because we match a output frame t with input frame t-2.
@@ -389,10 +567,10 @@ def train_streamvc(streamvc_model: StreamVC, args: argparse.Namespace) -> None:
             # Train Discriminator #
             #######################
 
-            discriminator.zero_grad()
-
-            discriminator_fake_detached = discriminator(x_pred_t.detach())
-            discriminator_real = discriminator(batch)
+            # A single forward on the real and generated audio together.
+            discriminator_real, discriminator_fake_detached = split_discriminator_outputs(
+                discriminator(torch.cat([batch, x_pred_t.detach()], dim=0)),
+                batch.shape[0])
 
             discriminator_loss = discriminator_loss_fn(
                 discriminator_real, discriminator_fake_detached, mask_ratio)
@@ -409,9 +587,10 @@ def train_streamvc(streamvc_model: StreamVC, args: argparse.Namespace) -> None:
             # Train Generator #
             ###################
 
-            generator.zero_grad()
-
-            discriminator_fake = discriminator(x_pred_t)
+            # The generator loss also populates the discriminator gradients,
+            # those are discarded so there is no need to synchronize them.
+            with accelerator.no_sync(discriminator):
+                discriminator_fake = discriminator(x_pred_t)
 
             # Compute adversarial loss.
             adversarial_loss = generator_loss_fn(
@@ -441,31 +620,36 @@ def train_streamvc(streamvc_model: StreamVC, args: argparse.Namespace) -> None:
             ######################
             # Update tensorboard #
             ######################
-            costs.append([
-                discriminator_loss.item(),
-                adversarial_loss.item(),
-                feature_loss.item(),
-                reconstruction_loss.item()
-            ])
-
-            accelerator.log(
-                {
-                    "loss/discriminator": discriminator_loss.item(),
-                    "loss/adversarial": adversarial_loss.item(),
-                    "loss/feature_matching": feature_loss.item(),
-                    "loss/reconstruction": reconstruction_loss.item(),
-                    "lr/generator": scheduler_generator.get_last_lr()[0],
-                    "lr/discriminator": scheduler_discriminator.get_last_lr()[0],
-                    "allocated_memory": torch.cuda.max_memory_allocated()
-                    if accelerator.device.type == "cuda"
-                    else 0
-                },
-                step=global_step)
+            costs_sum += torch.stack([
+                discriminator_loss,
+                adversarial_loss,
+                feature_loss,
+                reconstruction_loss
+            ]).detach()
+            costs_count += 1
 
             if (global_step + 1) % args.log_interval == 0:
+                costs = (costs_sum / costs_count).tolist()
+                accelerator.log(
+                    {
+                        "loss/discriminator": costs[0],
+                        "loss/adversarial": costs[1],
+                        "loss/feature_matching": costs[2],
+                        "loss/reconstruction": costs[3],
+                        "lr/generator": scheduler_generator.get_last_lr()[0],
+                        "lr/discriminator": scheduler_discriminator.get_last_lr()[0],
+                        "allocated_memory": torch.cuda.max_memory_allocated()
+                        if accelerator.device.type == "cuda"
+                        else 0
+                    },
+                    step=global_step)
                 print_time(
-                    f'[{epoch}, {step:5}] loss: {torch.tensor(costs).mean().item():.4}')
-                costs = []
+                    f'[{epoch}, {step:5}] loss: {sum(costs) / len(costs):.4}')
+                costs_sum.zero_()
+                costs_count = 0
+                # The reported peak memory covers the whole log interval.
+                if accelerator.device.type == "cuda":
+                    torch.cuda.reset_peak_memory_stats()
             if (global_step + 1) % args.model_checkpoint_interval == 0:
                 accelerator.save_model(
                     generator,
@@ -479,8 +663,6 @@ def train_streamvc(streamvc_model: StreamVC, args: argparse.Namespace) -> None:
                         args.checkpoint_path,
                         f"{args.run_name}_discriminator_{epoch}_{step}"
                     ))
-            if accelerator.device.type == "cuda":
-                torch.cuda.reset_peak_memory_stats()
 
             global_step += 1
 
@@ -514,13 +696,22 @@ def main(args):
 
     accelerator.init_trackers(args.run_name, config=hps)
     streamvc = StreamVC(
-        gradient_checkpointing=args.gradient_checkpointing)
+        gradient_checkpointing=args.gradient_checkpointing,
+        depthwise_separable=args.depthwise_separable)
     if args.module_to_train in ["content-encoder", "all"]:
         content_encoder = streamvc.content_encoder
-        hubert_model = torch.hub.load("bshall/hubert:main", "hubert_discrete",
-                                      trust_repo=True).to(torch.float32).eval()
+        if args.hubert_labels_cache:
+            hubert_model = None
+            train_labels_dir, dev_labels_dir = cache_hubert_labels(
+                {TRAIN_SPLIT: args.limit_num_batches,
+                 DEV_SPLIT: ACCURACY_NUM_BATCHES},
+                args)
+        else:
+            # TODO: distributed inference with the hubert model
+            hubert_model = load_hubert_model()
+            train_labels_dir = dev_labels_dir = None
         train_content_encoder(
-            content_encoder, hubert_model, args)
+            content_encoder, train_labels_dir, dev_labels_dir, hubert_model, args)
     else:
         wrapped_encoder_state_dict = st.torch.load_file(
             args.content_encoder_checkpoint)
@@ -534,6 +725,8 @@ def main(args):
     if args.module_to_train in ["decoder-and-speaker", "all"]:
         train_streamvc(streamvc, args)
 
+    wait_for_histograms()
+    histogram_executor.shutdown(wait=True)
     accelerator.end_training()
 
 
@@ -575,6 +768,12 @@ if __name__ == '__main__':
                         dest='gradient_checkpointing', default=True,
                         help="Disable gradient checkpointing to increase compute speed at the cost of increased memory"
                              "usage.")
+    parser.add_argument("--depthwise-separable", action="store_true",
+                        help="Use depthwise-separable dilated convolutions in the residual units with at least 64 "
+                             "channels to reduce compute. Models trained with it need the same flag for inference.")
+    parser.add_argument("--compile", action="store_true",
+                        help="Compile the trained models and the losses with torch.compile to fuse the convolutions, "
+                             "activations and elementwise loss terms.")
     # LR schedualers
     parser.add_argument("--scheduler", type=str, default="StepLR",
                         choices=["StepLR", "LinearLR",
@@ -631,6 +830,13 @@ if __name__ == '__main__':
                         default=os.path.join(os.environ.get(
                             "HF_HOME", os.getcwd()), "checkpoints"),
                         help="Path to save model checkpoints.")
+    parser.add_argument("--labels-cache-path", type=str,
+                        default=os.path.join(os.environ.get(
+                            "HF_HOME", os.getcwd()), "hubert_labels"),
+                        help="Path to cache the hubert labels used for the content encoder training.")
+    parser.add_argument("--no-hubert-labels-cache", action="store_false", dest="hubert_labels_cache",
+                        help="Compute the hubert labels on the fly during the content encoder training instead of "
+                             "caching them to disk beforehand.")
 
     args = parser.parse_args()
 